@@ -0,0 +1,116 @@
+import os
+import re
+import json
+import math
+import uuid
+import boto3
+import datetime
+from array import array
+from boto3.dynamodb.conditions import Key, Attr
+
+SQL_CACHE_TABLE_NAME = os.environ.get("SQL_CACHE_TABLE_NAME")
+EMBEDDING_MODEL = "amazon.titan-embed-text-v2:0"
+EMBEDDING_DIMENSIONS = 256
+SIMILARITY_THRESHOLD = 0.92
+CACHE_TTL = 60 * 60  # 1 hour
+
+# Numbers and quoted values, which change the meaning of a request without
+# moving its embedding much (e.g. "sales for 2023" and "sales for 2024")
+LITERAL_PATTERN = re.compile(r"\d+(?:[.,]\d+)*|'[^']*'|\"[^\"]*\"")
+
+_table = None
+
+
+def get_table():
+    # The DynamoDB resource is created on first use to keep it off the cold start
+    global _table
+
+    if _table is None and SQL_CACHE_TABLE_NAME:
+        _table = boto3.resource("dynamodb").Table(SQL_CACHE_TABLE_NAME)
+
+    return _table
+
+
+def embed_text(bedrock_client, text: str):
+    response = bedrock_client.invoke_model(
+        modelId=EMBEDDING_MODEL,
+        body=json.dumps(
+            {
+                "inputText": text,
+                "dimensions": EMBEDDING_DIMENSIONS,
+                "normalize": True,
+            }
+        ),
+    )
+
+    return json.loads(response["body"].read())["embedding"]
+
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+
+    return dot / norm if norm else 0.0
+
+
+def query_literals(text: str):
+    return sorted(LITERAL_PATTERN.findall(text.lower()))
+
+
+def get_cached_sql(embedding, user_id: str, database: str, user_query: str):
+    table = get_table()
+    if not table:
+        return None
+
+    now = int(datetime.datetime.now().timestamp())
+    query_params = {
+        "KeyConditionExpression": Key("userId").eq(user_id),
+        # Expired items are removed lazily by the DynamoDB TTL
+        "FilterExpression": Attr("expiresAt").gt(now) & Attr("database").eq(database),
+    }
+
+    literals = query_literals(user_query)
+    best_score, best_response = 0.0, None
+    while True:
+        response = table.query(**query_params)
+
+        for item in response["Items"]:
+            if query_literals(item["userQuery"]) != literals:
+                continue
+
+            cached_embedding = array("f", item["embedding"].value)
+            score = cosine_similarity(embedding, cached_embedding)
+            if score > best_score:
+                best_score, best_response = score, {
+                    "sql": item["sqlQuery"],
+                    "visualization": item.get("visualization", ""),
+                }
+
+        if "LastEvaluatedKey" not in response:
+            break
+        query_params["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    return best_response if best_score > SIMILARITY_THRESHOLD else None
+
+
+def put_cached_sql(
+    embedding, user_id: str, database: str, user_query: str, sql_response: dict
+):
+    table = get_table()
+    if not table:
+        return None
+
+    now = int(datetime.datetime.now().timestamp())
+
+    return table.put_item(
+        Item={
+            "userId": user_id,
+            "queryId": str(uuid.uuid4()),
+            "database": database,
+            "userQuery": user_query,
+            "sqlQuery": sql_response["sql"],
+            "visualization": sql_response["visualization"],
+            "embedding": array("f", embedding).tobytes(),
+            "expiresAt": now + CACHE_TTL,
+        }
+    )
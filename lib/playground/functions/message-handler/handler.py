@@ -1,30 +1,91 @@
+import io
 import os
+import re
+import csv
 import json
 import boto3
+from botocore.config import Config
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
 from common.sender import MessageSender
 from common.system import system_messages
 from tools import ToolProvider, ConverseToolExecutor, converse_tools
-from common.files import (
-    filter_inline_files,
-    get_inline_file_data,
-)
-from common.session import load_session, save_session, create_dynamodb_session
+from common.sql_cache import SQL_CACHE_TABLE_NAME, embed_text, get_cached_sql, put_cached_sql
 
 
 AWS_REGION = os.environ["AWS_REGION"]
 BEDROCK_REGION = os.environ.get("BEDROCK_REGION")
 BEDROCK_MODEL = os.environ.get("BEDROCK_MODEL")
-ARTIFACTS_ENABLED = os.environ.get("ARTIFACTS_ENABLED")
+ARTIFACTS_ENABLED = os.environ.get("ARTIFACTS_ENABLED") == "1"
 TOOL_CODE_INTERPRETER = os.environ.get("TOOL_CODE_INTERPRETER")
 TOOL_WEB_SEARCH = os.environ.get("TOOL_WEB_SEARCH")
 
+# Models supporting Converse prompt caching (matched against BEDROCK_MODEL,
+# which may carry a cross-region inference prefix such as "us.")
+PROMPT_CACHING_MODELS = (
+    "anthropic.claude-3-5-haiku",
+    "anthropic.claude-3-7-sonnet",
+    "anthropic.claude-sonnet-4",
+    "anthropic.claude-opus-4",
+    "amazon.nova-micro",
+    "amazon.nova-lite",
+    "amazon.nova-pro",
+    "amazon.nova-premier",
+)
+PROMPT_CACHING_ENABLED = any(model in (BEDROCK_MODEL or "") for model in PROMPT_CACHING_MODELS)
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+ALLOWED_SQL_PREFIXES = ("select", "with")
+VISUALIZATION_PATTERNS = {
+    "chart": re.compile(r"\b(chart|graph|plot)s?\b"),
+    "table": re.compile(r"\btables?\b"),
+}
+
+# Prompts used to generate the artifact for each visualization type
+ARTIFACT_PROMPTS = {
+    "chart": (
+        "Generate a Chart.js JSON structure using the following data: <data>{results}</data>. "
+        "Use one field as the labels for the x-axis, and the other field as the data for the y-axis in the 'datasets' property. "
+        "Ensure the JSON structure follows Chart.js conventions, including the 'labels', 'datasets', 'backgroundColor', and 'borderColor' properties. "
+        "Do not use HTML or artifact tags, return only the JSON object. "
+        "The data is an array of rows, the first row contains the column names."
+    ),
+    "table": (
+        "Create a table based on the following data and return a JSON structure in this format: "
+        "{{'title': string, 'elements': any[], 'totalElements': number}}. "
+        "Also, provide an HTML representation of the table using <x-artifact> tags. "
+        "Here is the data: <result>{results}</result>. "
+        "The data is an array of rows, the first row contains the column names. "
+        "Ensure the JSON structure includes a valid title, an array of data as 'elements', and the correct 'totalElements' count."
+    ),
+}
+
+ATHENA_POLL_INITIAL_DELAY = 0.2
+ATHENA_POLL_MAX_DELAY = 2
+# Keep below the Lambda timeout (15 minutes) so the query can be stopped
+ATHENA_POLL_TIMEOUT = int(os.environ.get("ATHENA_QUERY_TIMEOUT", "840"))
+ATHENA_RESULTS_PAGE_SIZE = 1000
+ATHENA_RESULT_REUSE_MINUTES = int(os.environ.get("ATHENA_RESULT_REUSE_MINUTES", "5"))
+
+# Shared by the clients so that connections are kept warm across invocations
+# and concurrent requests don't wait for a free connection
+client_config = Config(
+    max_pool_connections=50,
+    retries={"mode": "adaptive", "max_attempts": 3},
+    tcp_keepalive=True,
+)
 
 s3_client = boto3.client(
-    "s3", region_name=AWS_REGION, endpoint_url=f"https://s3.{AWS_REGION}.amazonaws.com"
+    "s3",
+    region_name=AWS_REGION,
+    endpoint_url=f"https://s3.{AWS_REGION}.amazonaws.com",
+    config=client_config,
+)
+bedrock_client = boto3.client(
+    "bedrock-runtime", region_name=BEDROCK_REGION, config=client_config
 )
-bedrock_client = boto3.client("bedrock-runtime", region_name=BEDROCK_REGION)
-athena_client = boto3.client("athena", region_name=AWS_REGION)
+athena_client = boto3.client("athena", region_name=AWS_REGION, config=client_config)
 
 provider = ToolProvider(
     {
@@ -33,6 +94,11 @@ provider = ToolProvider(
     }
 )
 
+background_pool = ThreadPoolExecutor(max_workers=1)
+
+# System prompt used when no files are attached, built once per container
+default_system = system_messages(ARTIFACTS_ENABLED, [])
+
 tool_config = []
 if TOOL_CODE_INTERPRETER:
     tool_config.append(converse_tools.code_interpreter)
@@ -48,6 +114,14 @@ def run_athena_query(query, database, output_bucket, logger):
         },
         ResultConfiguration={
             'OutputLocation': f's3://{output_bucket}/'
+        },
+        # Identical queries within the max age are served from the previous
+        # results instead of being executed again
+        ResultReuseConfiguration={
+            'ResultReuseByAgeConfiguration': {
+                'Enabled': True,
+                'MaxAgeInMinutes': ATHENA_RESULT_REUSE_MINUTES,
+            }
         }
     )
     return response['QueryExecutionId']
@@ -55,11 +129,14 @@ def run_athena_query(query, database, output_bucket, logger):
 def get_athena_query_results(query_execution_id, logger):
     logger.info(f"---------- get_athena_query_results")
     
-    # Polling for query status
+    # Polling for query status with geometric backoff (0.2s, 0.4s, 0.8s, ...)
+    # so that sub-second queries return as soon as they complete
+    delay = ATHENA_POLL_INITIAL_DELAY
+    deadline = time.monotonic() + ATHENA_POLL_TIMEOUT
     while True:
         execution = athena_client.get_query_execution(QueryExecutionId=query_execution_id)
         status = execution['QueryExecution']['Status']['State']
-        
+
         if status == 'SUCCEEDED':
             break
         elif status == 'FAILED':
@@ -67,24 +144,44 @@ def get_athena_query_results(query_execution_id, logger):
         elif status == 'CANCELLED':
             raise Exception("Query was cancelled")
 
-        time.sleep(2)  # Wait before checking again
+        if time.monotonic() + delay > deadline:
+            # Stop the query so Athena doesn't keep running (and billing) it
+            athena_client.stop_query_execution(QueryExecutionId=query_execution_id)
+            raise Exception(f"Query timed out after {ATHENA_POLL_TIMEOUT} seconds")
+
+        time.sleep(delay)  # Wait before checking again
+        delay = min(delay * 2, ATHENA_POLL_MAX_DELAY)
+
+    # Retrieve the results once the query has succeeded, streaming the CSV
+    # written by Athena to S3 in a single transfer when it is available
+    output_location = execution['QueryExecution'].get('ResultConfiguration', {}).get('OutputLocation')
+    if output_location and output_location.endswith('.csv'):
+        try:
+            return read_athena_output_csv(output_location, logger)
+        except s3_client.exceptions.NoSuchKey:
+            logger.warning(f"Athena output not found: {output_location}")
+
+    # Otherwise page through the results (the header row is only returned
+    # on the first page)
+    paginator = athena_client.get_paginator('get_query_results')
+    pages = paginator.paginate(
+        QueryExecutionId=query_execution_id,
+        PaginationConfig={'PageSize': ATHENA_RESULTS_PAGE_SIZE},
+    )
 
-    # Retrieve the results once the query has succeeded
-    results = []
-    next_token = None
+    return [row for page in pages for row in page['ResultSet']['Rows']]
 
-    while True:
-        params = { 'QueryExecutionId': query_execution_id }
-        if next_token:
-            params['NextToken'] = next_token
-
-        result_page = athena_client.get_query_results(**params)
-        results.extend(result_page['ResultSet']['Rows'])
-        next_token = result_page.get('NextToken')
-        if not next_token:
-            break
+def read_athena_output_csv(output_location, logger):
+    logger.info(f"---------- read_athena_output_csv")
+    bucket, key = output_location.removeprefix('s3://').split('/', 1)
+    body = s3_client.get_object(Bucket=bucket, Key=key)['Body']
 
-    return results
+    # Rows have the same shape as the ones returned by get_query_results
+    with io.TextIOWrapper(body, encoding='utf-8', newline='') as stream:
+        return [
+            {'Data': [{'VarCharValue': value} for value in row]}
+            for row in csv.reader(stream)
+        ]
 
 def execute_athena_query(query, database, output_bucket, logger):
     logger.info(f"---------- execute_athena_query")
@@ -103,6 +200,8 @@ def handle_message(logger, connection_id, user_id, body):
     logger.info(f"---------- Received message for {user_id}")
     logger.info(body)
     sender = MessageSender(connection_id)
+    embedding_future = None
+    cache_write = None
 
     try:
         session_id = body.get("session_id")
@@ -120,15 +219,19 @@ def handle_message(logger, connection_id, user_id, body):
             table_name = "bm-db-prototype.input"  # Nome della tabella in Athena
 
             logger.info(f"---------- Generating SQL query")
-            # Invia la richiesta a Bedrock per generare la query SQL
+            # Invia la richiesta a Bedrock per generare la query SQL e
+            # determinare se l'utente richiede un grafico o una tabella
             sql_query_message = {
                 "role": "user",
                 "content": [{
                     "text": (
                         f"Generate an SQL query based on the following user request: '{user_query}'. "
-                        "For example, if the user requests 'show all sales', the response should be 'SELECT * FROM sales;'. "
-                        "Only provide the SQL query, no explanations."
-                        "The query should be formatted in a single line and compatible with Athena."
+                        "Also determine whether the request is to generate a table or a chart using the query results. "
+                        "Answer with a JSON object in this format: {\"sql\": string, \"visualization\": \"chart\" | \"table\"}. "
+                        "For example, if the user requests 'show all sales', the response should be "
+                        "'{\"sql\": \"SELECT * FROM sales;\", \"visualization\": \"table\"}'. "
+                        "Only provide the JSON object, no explanations. "
+                        "The query should be formatted in a single line and compatible with Athena. "
                         f"Use the database '{database}' and the Athena table '{table_name}'."
                     )
                 }],
@@ -138,53 +241,117 @@ def handle_message(logger, connection_id, user_id, body):
             converse_messages = [sql_query_message]
             logger.info(f"---------- converse_messages: {converse_messages}")
 
-            # Invia il messaggio a Bedrock
-            sql_query_response = converse_make_request_stream(
-                sender,
-                user_id,
-                session_id,
-                converse_messages,
-                {},  # Non abbiamo ancora risultati
-                logger,
-                {},  # tool_extra
-                []   # files
-            )
+            # Reuse the SQL generated for a semantically similar request, if any
+            query_embedding = None
+            sql_query_response = None
+            sql_query_cacheable = False
+            if SQL_CACHE_TABLE_NAME:
+                # A visualization named in the request wins over the cached one,
+                # a request naming both can't reuse a cached entry
+                requested_visualizations = visualizations_from_query(user_query)
+                if len(requested_visualizations) <= 1:
+                    # The cache is only an optimization, errors are treated as a miss
+                    try:
+                        query_embedding = embed_text(bedrock_client, user_query)
+                        cached_response = get_cached_sql(query_embedding, user_id, database, user_query)
+                        if cached_response:
+                            visualization = (
+                                requested_visualizations[0]
+                                if requested_visualizations
+                                else cached_response["visualization"]
+                            )
+                            if visualization in ARTIFACT_PROMPTS:
+                                sql_query_response = {
+                                    "sql": cached_response["sql"],
+                                    "visualization": visualization,
+                                }
+                    except Exception as e:
+                        logger.warning(f"SQL query cache lookup failed: {e}")
+                        query_embedding = None
+                        sql_query_response = None
+                else:
+                    # No lookup is possible, the embedding is only needed to store
+                    # the generated SQL, so it runs while the SQL is generated
+                    embedding_future = background_pool.submit(embed_text, bedrock_client, user_query)
+
+            if sql_query_response:
+                logger.info(f"---------- SQL query cache hit")
+                cached_response_text = json.dumps(sql_query_response)
+                sender.send_text(cached_response_text)
+                converse_messages.append(
+                    {"role": "assistant", "content": [{"text": cached_response_text}]}
+                )
+            else:
+                # Invia il messaggio a Bedrock
+                response_text = converse_make_request_stream(
+                    sender,
+                    user_id,
+                    session_id,
+                    converse_messages,
+                    {},  # Non abbiamo ancora risultati
+                    logger,
+                    {},  # tool_extra
+                    []   # files
+                )
+                sql_query_response = parse_sql_query_response(response_text)
+                sql_query_cacheable = query_embedding is not None or embedding_future is not None
 
             logger.info(f"---------- Generated SQL query: {sql_query_response}")
             # Ottieni la risposta da Bedrock che contiene la query SQL
             if sql_query_response:
-                sql_query = sql_query_response.replace('\n', '').replace('\\', '')
+                sql_query = sql_query_response["sql"].replace('\n', '').replace('\\', '')
+                visualization = sql_query_response["visualization"]
                 logger.info(f"---------- Clean SQL query: {sql_query}")
 
-                # Validate the SQL query
-                if not sql_query.lower().startswith(('select', 'insert', 'update', 'delete')):
-                    raise ValueError("Generated query is not a valid SQL command.")
+                # Only read-only queries are executed (and therefore cached),
+                # anything else is rejected before reaching Athena
+                if not sql_query.lstrip().lower().startswith(ALLOWED_SQL_PREFIXES):
+                    raise ValueError("Generated query is not a valid SELECT query.")
 
                 # Esegui la query generata
                 results = execute_athena_query(sql_query, database, output_bucket, logger)
                 logger.info(f"---------- execute_athena_query results: {results}")
 
-                if results:
-                    query_results_str = json.dumps(results, indent=2)
-                    logger.info(f"---------- Athena query results: {query_results_str}")
-
-                # Chiedi a Bedrock di analizzare la richiesta e determinare l'intento
-                intent_message = {
-                    "role": "user",
-                    "content": [{
-                        # "text": f"Based on the user's input, determine whether a table or a chart would be the most appropriate visualization for this data. The user's request is: <input>{user_query}</input>. Here is the data: <data>{query_results_str}</data>.",
-                        "text": (
-                            f"Based on the user's input, determine whether the request is to generate a table or a chart using the provided data. This is the user's request: <input>{user_query}</input>. "
-                            "Always answer in english"
-                        ),
-                    }],
-                }
-
-                # Creiamo i messaggi da passare a Bedrock
-                converse_messages = [intent_message]
-
-                # Invia il messaggio a Bedrock per comprendere l'intento
-                intent_response = converse_make_request_stream(
+                if not results:
+                    raise ValueError("Failed to execute query")
+
+                # The cache write doesn't affect the response, so it runs while
+                # the artifact is being generated
+                if sql_query_cacheable and embedding_future:
+                    try:
+                        query_embedding = embedding_future.result()
+                    except Exception as e:
+                        logger.warning(f"SQL query embedding failed: {e}")
+                        sql_query_cacheable = False
+
+                if sql_query_cacheable:
+                    cache_write = background_pool.submit(
+                        put_cached_sql, query_embedding, user_id, database, user_query, sql_query_response
+                    )
+
+                # Strip Athena's per-cell envelope down to plain rows and serialize
+                # them compactly to keep the prompt small
+                rows = [[cell.get("VarCharValue", "") for cell in row["Data"]] for row in results]
+                query_results_str = json.dumps(rows, separators=(",", ":"))
+                logger.info(f"---------- Athena query results: {query_results_str}")
+
+                # Valuta la risposta di Bedrock per decidere se creare un grafico o una tabella
+                logger.info(f"---------- visualization: {visualization}")
+                generative_messages = [
+                    {
+                        "role": "user",
+                        "content": [{
+                            "text": ARTIFACT_PROMPTS[visualization].format(results=query_results_str),
+                        }],
+                    },
+                ]
+
+                # Continue the same conversation so the system prompt and the
+                # SQL exchange form a stable prefix for Bedrock prompt caching
+                converse_messages.extend(generative_messages)
+
+                # Invia il messaggio a Bedrock per comprendere generare la tabella o il grafico
+                converse_make_request_stream(
                     sender,
                     user_id,
                     session_id,
@@ -195,68 +362,53 @@ def handle_message(logger, connection_id, user_id, body):
                     []   # files
                 )
 
-                # Valuta la risposta di Bedrock per decidere se creare un grafico o una tabella
-                if intent_response and query_results_str:
-                    logger.info(f"---------- intent_response: {"chart" in intent_response.lower()}")
-                    if "chart" in intent_response.lower():
-                        generative_messages = [
-                            {
-                                "role": "user",
-                                "content": [{
-                                    "text": (
-                                        # f"Create a chart based on this data and return it as a Chart.js JSON structure: <result>{query_results_str}</result>"
-                                        # f"Use the 'labels' property as the x-axis and the 'dataset.data' property as the y-axis"
-                                        f"Generate a Chart.js JSON structure using the following data: <data>{query_results_str}</data>. "
-                                        f"Use one field as the labels for the x-axis, and the other field as the data for the y-axis in the 'datasets' property. "
-                                        "Ensure the JSON structure follows Chart.js conventions, including the 'labels', 'datasets', 'backgroundColor', and 'borderColor' properties. "
-                                        "Do not use HTML or artifact tags, return only the JSON object. "
-                                        "Ignore the first object if it contains just the property names."
-                                    )
-                                }],
-                            },
-                        ]
-                    elif "table" in intent_response.lower():
-                        generative_messages = [
-                            {
-                                "role": "user",
-                                "content": [{
-                                    "text": (
-                                        f"Create a table based on the following data and return a JSON structure in this format: "
-                                        f"{{'title': string, 'elements': any[], 'totalElements': number}}. "
-                                        f"Also, provide an HTML representation of the table using <x-artifact> tags. "
-                                        f"Here is the data: <result>{query_results_str}</result>. "
-                                        f"Ensure the JSON structure includes a valid title, an array of data as 'elements', and the correct 'totalElements' count."
-                                    )
-                                }],
-                            },
-                        ]
-                    else:
-                        sender.send_error("Unable to determine visualization type.")
-                
-                if generative_messages:
-                    # Invia il messaggio a Bedrock per comprendere generare la tabella o il grafico
-                    generative_response = converse_make_request_stream(
-                        sender,
-                        user_id,
-                        session_id,
-                        generative_messages,
-                        results,
-                        logger,
-                        {},  # tool_extra
-                        []   # files
-                    )
-
-                sender.send_loop(generative_response)
+                sender.send_loop(True)
             else:
-                sender.send_error("Failed to execute query")
+                sender.send_error("Failed to generate SQL query")
         else:
             raise ValueError(f"Unknown event type: {event_type}")
     except Exception as e:
         logger.error(f"Error processing message: {e}")
         sender.send_error(str(e))
+    finally:
+        # Wait for the background calls so they complete before Lambda freezes
+        # the environment, a failure doesn't affect the response already sent
+        if embedding_future:
+            wait([embedding_future])
+        if cache_write and cache_write.exception():
+            logger.warning(f"SQL query cache write failed: {cache_write.exception()}")
 
     return {"statusCode": 200, "body": json.dumps({"ok": True})}
 
+def visualizations_from_query(user_query):
+    user_query = user_query.lower()
+
+    return [
+        visualization
+        for visualization, pattern in VISUALIZATION_PATTERNS.items()
+        if pattern.search(user_query)
+    ]
+
+def parse_sql_query_response(response_text):
+    # The model may surround the JSON object with extra text or code fences
+    start = response_text.find("{")
+    end = response_text.rfind("}")
+
+    try:
+        response = json.loads(response_text[start:end + 1])
+    except ValueError:
+        return None
+
+    if not isinstance(response, dict) or not response.get("sql"):
+        return None
+
+    # Answers with an unknown visualization are rejected so they are never cached
+    visualization = str(response.get("visualization", "")).lower()
+    if visualization not in ARTIFACT_PROMPTS:
+        return None
+
+    return {"sql": response["sql"], "visualization": visualization}
+
 def converse_make_request_stream(
     sender: MessageSender,
     user_id,
@@ -268,14 +420,20 @@ def converse_make_request_stream(
     files,
 ):
     logger.info(f"---------- converse_make_request_stream results: '{results}'")
-    file_names = [os.path.basename(file["file_name"]) for file in files]
-    system = system_messages(ARTIFACTS_ENABLED == "1", file_names)
+    system = default_system
+    if files:
+        file_names = [os.path.basename(file["file_name"]) for file in files]
+        system = system_messages(ARTIFACTS_ENABLED, file_names)
+
+    messages = converse_messages
+    if PROMPT_CACHING_ENABLED:
+        system, messages = add_cache_points(system, converse_messages)
 
     # Effettuiamo una chiamata per generare una risposta dallo stream Bedrock
     streaming_response = bedrock_client.converse_stream(
         modelId=BEDROCK_MODEL,
         system=system,
-        messages=converse_messages,
+        messages=messages,
         inferenceConfig={"maxTokens": 4096, "temperature": 0},
         **{},
     )
@@ -283,17 +441,38 @@ def converse_make_request_stream(
 
     executor = ConverseToolExecutor(user_id, session_id, provider)
 
-    response_text = ""
-    for chunk in streaming_response["stream"]:
-        # logger.info(f"---------- streaming_response chunk: '{chunk}'")
-        # Elaboriamo lo stream e inviamo il testo all'utente
-        text = executor.process_chunk(chunk)
-        # logger.info(f"---------- streaming_response text: '{text}'")
-        if text:
-            sender.send_text(text)
-            response_text += text  # Accumula la risposta
-        else:
-            logger.warning("Chunk processed but no text returned.")
+    # Posting to the websocket is offloaded to a single worker thread so that
+    # reading the Bedrock stream is not blocked by each round-trip; a single
+    # worker keeps the chunks in order
+    send_futures = deque()
+    with ThreadPoolExecutor(max_workers=1) as send_pool:
+        try:
+            for chunk in streaming_response["stream"]:
+                # logger.info(f"---------- streaming_response chunk: '{chunk}'")
+                # Elaboriamo lo stream e inviamo il testo all'utente
+                text = executor.process_chunk(chunk)
+                # logger.info(f"---------- streaming_response text: '{text}'")
+                if text:
+                    send_futures.append(send_pool.submit(sender.send_text, text))
+                else:
+                    logger.warning("Chunk processed but no text returned.")
+
+                # Stop reading the stream on the first failed send (e.g. the
+                # websocket connection is gone)
+                while send_futures and send_futures[0].done():
+                    send_futures.popleft().result()
+
+            while send_futures:
+                send_futures.popleft().result()
+        except Exception:
+            # Close the event stream so Bedrock stops generating the response
+            streaming_response["stream"].close()
+            for future in send_futures:
+                future.cancel()
+            raise
+
+    # Il testo della risposta è già accumulato dall'executor
+    response_text = executor.get_text()
     logger.info(f"---------- response_text '{response_text}'")
 
     # Recuperiamo i messaggi dell'assistente
@@ -301,4 +480,24 @@ def converse_make_request_stream(
     logger.info(f"---------- assistant_messages '{assistant_messages}'")
     converse_messages.extend(assistant_messages)
 
-    return response_text.strip()  # Restituisci la risposta finale
\ No newline at end of file
+    return response_text.strip()  # Restituisci la risposta finale
+
+
+def add_cache_points(system, converse_messages):
+    # Cache points are only added to the request, the stored conversation is
+    # left untouched so they don't pile up across turns
+    system = [*system, CACHE_POINT]
+
+    # Only the first user message (the SQL request) is shared by the calls of
+    # a CONVERSE event; later prompts carry per-request data such as the
+    # Athena rows, which would be written to the cache but never read back
+    messages = list(converse_messages)
+    for idx in range(len(messages)):
+        if messages[idx]["role"] == "user":
+            messages[idx] = {
+                **messages[idx],
+                "content": [*messages[idx]["content"], CACHE_POINT],
+            }
+            break
+
+    return system, messages
@@ -10,7 +10,7 @@ class ConverseToolExecutor:
         self.user_id = user_id
         self.session_id = session_id
         self.provider = provider
-        self.text_accumulator = ""
+        self.text_parts = []
         self.tool_use = {}
         self.stop_on_tool_use = False
         self.tool_results = []
@@ -43,7 +43,7 @@ class ConverseToolExecutor:
             text = delta.get("text")
 
         if text:
-            self.text_accumulator += text
+            self.text_parts.append(text)
             return text
         if tool_use:
             current_tool_use = self.tool_use.get(content_block_index)
@@ -79,7 +79,7 @@ class ConverseToolExecutor:
             tool_use = current.get("toolUse")
 
             if text:
-                self.text_accumulator += text
+                self.text_parts.append(text)
 
             if tool_use:
                 current_tool_use = {
@@ -91,7 +91,7 @@ class ConverseToolExecutor:
                 self.tool_use[idx] = current_tool_use
 
     def get_text(self):
-        return self.text_accumulator
+        return "".join(self.text_parts)
 
     def execution_requested(self):
         return self.stop_on_tool_use
@@ -151,12 +151,13 @@ class ConverseToolExecutor:
             )
 
     def get_assistant_messages(self):
-        if not self.text_accumulator and not self.tool_use:
+        text = self.get_text()
+        if not text and not self.tool_use:
             return []
 
         content = []
-        if self.text_accumulator:
-            content.append({"text": self.text_accumulator})
+        if text:
+            content.append({"text": text})
 
         tool_use = self.get_formatted_tool_use()
         values = [{"toolUse": current} for current in tool_use]
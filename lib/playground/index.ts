@@ -444,6 +444,18 @@ export class Playground extends Construct {
       partitionKey: { name: "userId", type: dynamodb.AttributeType.STRING },
     });
 
+    const sqlCacheTable = new dynamodb.Table(this, "SqlCacheTable", {
+      partitionKey: {
+        name: "userId",
+        type: dynamodb.AttributeType.STRING,
+      },
+      sortKey: { name: "queryId", type: dynamodb.AttributeType.STRING },
+      timeToLiveAttribute: "expiresAt",
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      encryption: dynamodb.TableEncryption.AWS_MANAGED,
+      removalPolicy: cdk.RemovalPolicy.DESTROY,
+    });
+
     const connectionHandlerFunction = new lambda.Function(
       this,
       "ConnectionHandlerFunction",
@@ -518,6 +530,7 @@ export class Playground extends Construct {
           SESSION_TABLE_NAME: sessionTable.tableName,
           SESSION_BUCKET_NAME: sessionBucket.bucketName,
           UPLOAD_BUCKET_NAME: uploadBucket.bucketName,
+          SQL_CACHE_TABLE_NAME: sqlCacheTable.tableName,
           ARTIFACTS_ENABLED: config.artifacts?.enabled ? "1" : "0",
           TOOL_CODE_INTERPRETER: codeInterpreterTool?.functionArn ?? "",
           TOOL_WEB_SEARCH: webSearchTool?.functionArn ?? "",
@@ -533,6 +546,7 @@ export class Playground extends Construct {
           "athena:StartQueryExecution",
           "athena:GetQueryExecution",
           "athena:GetQueryResults",
+          "athena:StopQueryExecution",
           "s3:*",
           "glue:*",
         ],
@@ -559,6 +573,7 @@ export class Playground extends Construct {
     codeInterpreterTool?.grantInvoke(messageHandler);
     webSearchTool?.grantInvoke(messageHandler);
     sessionTable.grantReadWriteData(messageHandler);
+    sqlCacheTable.grantReadWriteData(messageHandler);
     sessionBucket.grantReadWrite(messageHandler);
     uploadBucket.grantReadWrite(messageHandler);
 